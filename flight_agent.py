@@ -4,201 +4,265 @@ With Airbnb, Hotels, Images, Flight Times, and Enhanced Restaurant Recommendatio
 """
 
 import os
-from datetime import datetime, timedelta
-import json
+import atexit
+import hashlib
+import heapq
+import logging
+import string
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, timedelta
+from itertools import islice
+import re
+from operator import attrgetter
+from urllib.parse import quote, urlencode
 from anthropic import Anthropic
+from cachetools import TTLCache
+import orjson
+import redis
 import requests
-from flask import Flask, request, jsonify, send_from_directory
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, request, jsonify, send_from_directory
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+SERPAPI_URL = "https://serpapi.com/search"
+# Upper bound on concurrent SerpAPI calls per flexible-date sweep (rate limits)
+MAX_SEARCH_WORKERS = 16
+# (connect, read) seconds; SerpAPI sends nothing until a search completes, so reads get longer
+SERPAPI_TIMEOUT = (3.05, 30)
+# Retries on top of the first attempt, with exponential backoff between them
+SERPAPI_RETRIES = 3
+SERPAPI_BACKOFF = 0.3
+# SerpAPI cache lifetimes in seconds; flight prices move faster than hotels
+FLIGHT_CACHE_TTL = 600
+HOTEL_CACHE_TTL = 1800
+# How long past its TTL a cached response with ETag/Last-Modified is kept for revalidation
+CACHE_REVALIDATE_WINDOW = 3600
+# Airbnb search filters offered as accommodation options
+AIRBNB_ROOM_TYPES = ("Entire home/apt", "Private room")
+# json_restrictor filters so SerpAPI only returns the fields we read
+FLIGHTS_JSON_RESTRICTOR = (
+    "best_flights[].{price,total_duration,"
+    "flights[].{airline,airline_logo,duration,layovers,departure_airport.{id,time},arrival_airport.{id,time}}}"
+)
+HOTELS_JSON_RESTRICTOR = (
+    "properties[].{name,rate_per_night,total_rate,overall_rating,reviews,link,description,images,amenities}"
+)
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by jsonify and request.json"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Skip the str round-trip of the default implementation; orjson already produces bytes
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
 
 app = Flask(__name__, static_folder='.')
+app.json = OrjsonProvider(app)
+# Compress the page and JSON bodies; the NDJSON itinerary stream is not in
+# COMPRESS_MIMETYPES, so it is still flushed line by line
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 1024
+Compress(app)
 client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 
-class TravelPlanningAgent:
-    def __init__(self):
-        self.serpapi_key = os.environ.get("SERPAPI_KEY")
-        
-    def search_flights(self, origin, destination, outbound_date, return_date=None):
-        """Search flights with detailed times and prices"""
-        params = {
-            "engine": "google_flights",
-            "departure_id": origin,
-            "arrival_id": destination,
-            "outbound_date": outbound_date,
-            "currency": "GBP",
-            "hl": "en",
-            "api_key": self.serpapi_key
-        }
-        
-        if return_date:
-            params["return_date"] = return_date
-            params["type"] = "1"
-        
-        try:
-            response = requests.get("https://serpapi.com/search", params=params, timeout=30)
-            return response.json()
-        except Exception as e:
-            print(f"Flight search error: {e}")
-            return {"error": str(e)}
+# Shared session so SerpAPI calls reuse pooled TCP/TLS connections
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    # Ride out brief SerpAPI gateway errors and failed connects instead of failing that
+    # date's search. Read timeouts are not retried: the search may already be running
+    # (and billed) upstream, and another 30s wait would rarely help
+    max_retries=Retry(
+        total=SERPAPI_RETRIES,
+        read=0,
+        backoff_factor=SERPAPI_BACKOFF,
+        status_forcelist=[502, 503, 504]
+    )
+))
+atexit.register(http_session.close)
+
+# Optional shared SerpAPI response and itinerary cache; disabled when REDIS_URL is unset.
+# Short socket timeouts so an unreachable Redis degrades to a cache miss instead of
+# stalling every search until the OS gives up on the connection
+REDIS_SOCKET_TIMEOUT = 0.5
+redis_client = redis.Redis.from_url(
+    os.environ["REDIS_URL"],
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT
+) if os.environ.get("REDIS_URL") else None
+
+# Per-process caches checked before Redis; keys are the same normalized query hashes
+flight_cache = TTLCache(maxsize=1024, ttl=FLIGHT_CACHE_TTL)
+hotel_cache = TTLCache(maxsize=1024, ttl=HOTEL_CACHE_TTL)
+flexible_dates_cache = TTLCache(maxsize=256, ttl=FLIGHT_CACHE_TTL)
+local_cache_lock = threading.Lock()
+
+# SerpAPI queries currently being fetched, so identical concurrent queries share one call
+_inflight = {}
+_inflight_lock = threading.Lock()
+# Followers wait out the leader's worst case: every attempt timing out, plus backoff
+# sleeps and a little slack for the Redis round trips
+INFLIGHT_WAIT_TIMEOUT = (
+    (SERPAPI_RETRIES + 1) * sum(SERPAPI_TIMEOUT)
+    + SERPAPI_BACKOFF * 2 ** SERPAPI_RETRIES
+    + 5
+)
+
+def _serpapi_cache_key(params):
+    """Stable cache key for a SerpAPI query, ignoring the API key"""
+    query = {k: v for k, v in params.items() if k != "api_key"}
+    digest = hashlib.blake2b(orjson.dumps(query, option=orjson.OPT_SORT_KEYS, default=str)).hexdigest()
+    return f"serpapi:{digest}"
+
+def _cache_get(key):
+    try:
+        cached = redis_client.get(key)
+    except redis.RedisError as e:
+        logger.warning("Cache read error: %s", e)
+        return None
+    return orjson.loads(cached) if cached is not None else None
+
+def _cache_set(key, ttl, data):
+    try:
+        redis_client.setex(key, ttl, orjson.dumps(data))
+    except redis.RedisError as e:
+        logger.warning("Cache write error: %s", e)
+
+def _fetch_serpapi(key, params, ttl, result_key):
+    if redis_client is None:
+        return orjson.loads(http_session.get(SERPAPI_URL, params=params, timeout=SERPAPI_TIMEOUT).content)
     
-    def search_hotels(self, destination, check_in, check_out):
-        """Search hotels with images and detailed info"""
-        params = {
-            "engine": "google_hotels",
-            "q": destination,
-            "check_in_date": check_in,
-            "check_out_date": check_out,
-            "currency": "GBP",
-            "gl": "uk",
-            "hl": "en",
-            "api_key": self.serpapi_key
-        }
-        
-        try:
-            response = requests.get("https://serpapi.com/search", params=params, timeout=30)
-            return response.json()
-        except Exception as e:
-            print(f"Hotel search error: {e}")
-            return {"error": str(e)}
+    entry = _cache_get(key)
+    if entry is not None and time.time() - entry["fetched_at"] < ttl:
+        return entry["data"]
     
-    def search_airbnb(self, destination, check_in, check_out):
-        """Search Airbnb listings"""
-        check_in_date = datetime.strptime(check_in, "%Y-%m-%d")
-        check_out_date = datetime.strptime(check_out, "%Y-%m-%d")
-        nights = (check_out_date - check_in_date).days
-        
-        params = {
-            "engine": "google",
-            "q": f"airbnb {destination}",
-            "api_key": self.serpapi_key,
-            "num": 10
-        }
-        
-        try:
-            response = requests.get("https://serpapi.com/search", params=params, timeout=30)
-            results = response.json()
-            
-            airbnb_listings = []
-            if "organic_results" in results:
-                for result in results["organic_results"][:8]:
-                    if "airbnb" in result.get("link", "").lower():
-                        airbnb_listings.append({
-                            "name": result.get("title", "Airbnb Listing"),
-                            "description": result.get("snippet", ""),
-                            "link": result.get("link", "#"),
-                            "price_per_night": "50-150",
-                            "total_price": f"{nights * 75}",
-                            "type": "Entire home/Private room"
-                        })
-            
-            return airbnb_listings
-        except Exception as e:
-            print(f"Airbnb search error: {e}")
-            return []
+    # Stale entries are revalidated so an unchanged result comes back as a bodiless 304
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
     
-    def analyze_flexible_dates(self, origin, destination, start_date, return_date, days_range=7):
-        """Search flights across flexible dates with detailed flight info"""
-        results = []
-        base_date = datetime.strptime(start_date, "%Y-%m-%d")
-        
-        if return_date:
-            return_date_obj = datetime.strptime(return_date, "%Y-%m-%d")
-        
-        for i in range(days_range):
-            search_date = (base_date + timedelta(days=i)).strftime("%Y-%m-%d")
-            search_return = (return_date_obj + timedelta(days=i)).strftime("%Y-%m-%d") if return_date else None
-            
-            flight_data = self.search_flights(origin, destination, search_date, search_return)
-            
-            if "best_flights" in flight_data:
-                for flight in flight_data.get("best_flights", [])[:3]:
-                    flights_info = flight.get("flights", [])
-                    
-                    outbound_flight = flights_info[0] if flights_info else {}
-                    
-                    return_flight = None
-                    if len(flights_info) > 1:
-                        return_flight = flights_info[1]
-                    
-                    flight_details = {
-                        "outbound_date": search_date,
-                        "return_date": search_return,
-                        "price": flight.get("price"),
-                        "total_duration": flight.get("total_duration"),
-                        "airline": outbound_flight.get("airline", "Unknown"),
-                        "airline_logo": outbound_flight.get("airline_logo", ""),
-                        
-                        "outbound_departure_time": outbound_flight.get("departure_airport", {}).get("time", ""),
-                        "outbound_arrival_time": outbound_flight.get("arrival_airport", {}).get("time", ""),
-                        "outbound_departure_airport": outbound_flight.get("departure_airport", {}).get("id", origin),
-                        "outbound_arrival_airport": outbound_flight.get("arrival_airport", {}).get("id", destination),
-                        "outbound_duration": outbound_flight.get("duration"),
-                        
-                        "return_departure_time": return_flight.get("departure_airport", {}).get("time", "") if return_flight else "",
-                        "return_arrival_time": return_flight.get("arrival_airport", {}).get("time", "") if return_flight else "",
-                        "return_duration": return_flight.get("duration") if return_flight else "",
-                        
-                        "booking_link": f"https://www.google.com/travel/flights?q={origin}+to+{destination}+on+{search_date}",
-                        "layovers": outbound_flight.get("layovers", [])
-                    }
-                    
-                    results.append(flight_details)
-        
-        return results
+    response = http_session.get(SERPAPI_URL, params=params, headers=headers, timeout=SERPAPI_TIMEOUT)
+    if response.status_code == 304 and entry is not None:
+        data = entry["data"]
+        etag, last_modified = entry.get("etag"), entry.get("last_modified")
+    else:
+        data = orjson.loads(response.content)
+        if "error" in data or not data.get(result_key):
+            return data
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
     
-    def create_structured_itinerary(self, destination, keywords, budget, duration_days, hotels):
-        """Create comprehensive structured itinerary with AI"""
-        hotel_info = ""
-        if hotels and "properties" in hotels:
-            top_hotels = hotels["properties"][:3]
-            hotel_info = "\n\nTop Hotels:\n"
-            for hotel in top_hotels:
-                hotel_info += f"- {hotel.get('name', 'N/A')}: £{hotel.get('rate_per_night', {}).get('lowest', 'N/A')}/night\n"
-        
-        prompt = f"""Create a detailed {duration_days}-day structured itinerary for {destination}.
+    # Without validators a stale entry is useless, so only keep it past ttl when it can be revalidated
+    expiry = ttl + CACHE_REVALIDATE_WINDOW if etag or last_modified else ttl
+    _cache_set(key, expiry, {
+        "data": data,
+        "fetched_at": time.time(),
+        "etag": etag,
+        "last_modified": last_modified
+    })
+    return data
+
+def serpapi_search(params, local_cache, result_key):
+    """Run a SerpAPI search; concurrent duplicates share one call and non-empty results are cached"""
+    key = _serpapi_cache_key(params)
+    
+    with local_cache_lock:
+        data = local_cache.get(key)
+    if data is not None:
+        return data
+    
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _inflight[key] = Future()
+    
+    if not is_leader:
+        return future.result(timeout=INFLIGHT_WAIT_TIMEOUT)
+    
+    try:
+        data = _fetch_serpapi(key, params, local_cache.ttl, result_key)
+        # Errors and empty result sets are retried next time rather than cached
+        if "error" not in data and data.get(result_key):
+            with local_cache_lock:
+                local_cache[key] = data
+        future.set_result(data)
+        return data
+    except BaseException as e:
+        # Always resolve the future so followers never wait on an abandoned call
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+# Static itinerary instructions and JSON schema. Keep it byte-identical across requests
+# so it stays a reusable prompt prefix. At roughly 600 tokens it is below Anthropic's
+# minimum cacheable prefix (1024 tokens for Sonnet, 4096 for Haiku 4.5), so a plain
+# request is never cached; the cache_control breakpoints only take effect once
+# refinement history grows the prompt past the model's minimum.
+ITINERARY_SYSTEM_PROMPT = """You are a travel planner that creates detailed, structured day-by-day itineraries.
 
 IMPORTANT: Return ONLY valid JSON with this exact structure:
-{{
-  "overview": {{
-    "destination": "{destination}",
+{
+  "overview": {
+    "destination": "Destination name",
     "best_time_to_visit": "description",
     "getting_around": "transport tips",
     "money_saving_tips": ["tip1", "tip2", "tip3"],
     "local_customs": "brief cultural tips"
-  }},
+  },
   "daily_itinerary": [
-    {{
+    {
       "day": 1,
       "theme": "Day theme",
-      "morning": {{
+      "morning": {
         "time": "9:00 AM",
         "activity": "Activity name",
         "description": "What to do",
         "cost": 15,
         "duration": "2 hours",
         "location": "Specific area/neighborhood"
-      }},
-      "afternoon": {{
+      },
+      "afternoon": {
         "time": "2:00 PM",
         "activity": "Activity name",
         "description": "What to do",
         "cost": 25,
         "duration": "3 hours",
         "location": "Specific area/neighborhood"
-      }},
-      "evening": {{
+      },
+      "evening": {
         "time": "7:00 PM",
         "activity": "Activity name",
         "description": "What to do",
         "cost": 35,
         "duration": "2 hours",
         "location": "Specific area/neighborhood"
-      }},
+      },
       "daily_total": 75
-    }}
+    }
   ],
-  "restaurants": {{
+  "restaurants": {
     "breakfast": [
-      {{
+      {
         "name": "Restaurant name",
         "cuisine": "cuisine type",
         "price_per_person": 12,
@@ -206,10 +270,10 @@ IMPORTANT: Return ONLY valid JSON with this exact structure:
         "description": "Why to visit",
         "neighborhood": "Area name",
         "signature_dish": "Popular dish"
-      }}
+      }
     ],
     "lunch": [
-      {{
+      {
         "name": "Restaurant name",
         "cuisine": "cuisine type",
         "price_per_person": 18,
@@ -217,10 +281,10 @@ IMPORTANT: Return ONLY valid JSON with this exact structure:
         "description": "Why to visit",
         "neighborhood": "Area name",
         "signature_dish": "Popular dish"
-      }}
+      }
     ],
     "dinner": [
-      {{
+      {
         "name": "Restaurant name",
         "cuisine": "cuisine type",
         "price_per_person": 35,
@@ -228,66 +292,536 @@ IMPORTANT: Return ONLY valid JSON with this exact structure:
         "description": "Why to visit",
         "neighborhood": "Area name",
         "signature_dish": "Popular dish"
-      }}
+      }
     ]
-  }},
-  "budget_summary": {{
+  },
+  "budget_summary": {
     "activities": 200,
     "food": 300,
     "transport": 50,
     "accommodation_estimate": 400,
     "total_estimate": 950
-  }}
-}}
-
-User interests: {', '.join(keywords)}
-Budget available: £{budget}
-{hotel_info}
+  }
+}
 
 Include 5-6 restaurants for each meal type (breakfast, lunch, dinner).
 Provide realistic star ratings (out of 5) and accurate average prices per person in GBP.
 
 Respond ONLY with valid JSON."""
 
+# Itinerary drafts go to the faster model; the larger one is the fallback
+ITINERARY_MODEL = "claude-haiku-4-5-20251001"
+ITINERARY_FALLBACK_MODEL = "claude-sonnet-4-20250514"
+# Output budget: overview and restaurants plus roughly 700 tokens per day, capped lower
+# for the fast model so long trips that outgrow it get the fallback's extra headroom
+ITINERARY_BASE_TOKENS = 1200
+ITINERARY_TOKENS_PER_DAY = 700
+ITINERARY_MAX_TOKENS = 5000
+ITINERARY_FALLBACK_MAX_TOKENS = 16000
+
+class ItineraryTruncated(ValueError):
+    """The model hit max_tokens before finishing the itinerary"""
+
+_price_key = attrgetter("price")
+
+# Body of a ```json ... ``` (or bare ```) fence in model output
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+
+# Per-request part of the itinerary prompt, appended after the system block
+ITINERARY_REQUEST_TEMPLATE = string.Template("""Create a detailed ${duration_days}-day structured itinerary for ${destination}.
+
+User interests: ${keywords}
+Budget available: £${budget}
+${hotel_info}""")
+
+# Generated itineraries, keyed by trip shape; budgets are bucketed so nearby ones share entries
+ITINERARY_CACHE_TTL = 86400
+ITINERARY_BUDGET_BUCKET = 250
+itinerary_cache = TTLCache(maxsize=1024, ttl=ITINERARY_CACHE_TTL)
+itinerary_cache_lock = threading.Lock()
+
+def _itinerary_cache_key(destination, keywords, budget, duration_days):
+    interests = "|".join(sorted(k.lower() for k in keywords))
+    budget_bucket = round(budget / ITINERARY_BUDGET_BUCKET) * ITINERARY_BUDGET_BUCKET
+    # Destination and interests are free text, so hash them into a fixed-size key
+    trip = f"{destination.lower()}:{interests}:{budget_bucket}:{duration_days}"
+    return f"itin:{hashlib.blake2b(trip.encode(), digest_size=16).hexdigest()}"
+
+def _with_cache_breakpoints(messages):
+    """Copy messages, marking the last two user turns as prompt-cache breakpoints"""
+    # The newest breakpoint caches this turn; the previous one reads the prefix cached last turn.
+    # Anthropic ignores breakpoints whose prefix is under the model's minimum cacheable length,
+    # so in practice only longer refinement conversations are cached
+    marked = list(messages)
+    remaining = 2
+    for i in range(len(marked) - 1, -1, -1):
+        if not remaining:
+            break
+        message = marked[i]
+        if message["role"] != "user":
+            continue
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        content = [dict(block) for block in content]
+        content[-1]["cache_control"] = {"type": "ephemeral"}
+        marked[i] = {**message, "content": content}
+        remaining -= 1
+    return marked
+
+def _is_valid_itinerary(itinerary):
+    """Check the model returned the parts of the schema the frontend renders"""
+    return (
+        isinstance(itinerary, dict)
+        and isinstance(itinerary.get("daily_itinerary"), list)
+        and len(itinerary["daily_itinerary"]) > 0
+        and isinstance(itinerary.get("restaurants"), dict)
+    )
+
+@dataclass(slots=True, frozen=True)
+class FlightRecord:
+    """One flight option from the flexible-date sweep; serialized as-is by orjson"""
+    outbound_date: str
+    return_date: str | None
+    price: int | None
+    total_duration: int | None
+    airline: str
+    airline_logo: str
+    outbound_departure_time: str
+    outbound_arrival_time: str
+    outbound_departure_airport: str
+    outbound_arrival_airport: str
+    outbound_duration: int | None
+    return_departure_time: str
+    return_arrival_time: str
+    return_duration: int | str | None
+    booking_link: str
+    layovers: list
+
+@dataclass(slots=True, frozen=True)
+class HotelOption:
+    """One hotel card in the /itinerary response"""
+    name: str
+    price_per_night: str
+    total_price: str
+    rating: float | str
+    reviews: int
+    link: str
+    description: str
+    images: list
+    amenities: list
+    type: str = "hotel"
+
+@dataclass(slots=True, frozen=True)
+class AirbnbOption:
+    """One Airbnb search card in the /itinerary response"""
+    name: str
+    price_per_night: str
+    total_price: str
+    description: str
+    link: str
+    property_type: str
+    type: str = "airbnb"
+
+def _hotel_option(hotel):
+    """Build a HotelOption from one SerpAPI properties entry"""
+    rate = hotel.get("rate_per_night")
+    total = hotel.get("total_rate")
+    return HotelOption(
+        name=hotel.get("name", "N/A"),
+        price_per_night=rate.get("lowest", "N/A") if rate else "N/A",
+        total_price=total.get("lowest", "N/A") if total else "N/A",
+        rating=hotel.get("overall_rating", "N/A"),
+        reviews=hotel.get("reviews", 0),
+        link=hotel.get("link", "#"),
+        description=(hotel.get("description") or "")[:200],
+        # The page only shows thumbnails, so drop the full-size image URLs
+        images=[image["thumbnail"] for image in islice(hotel.get("images") or (), 3) if image.get("thumbnail")],
+        amenities=(hotel.get("amenities") or [])[:5]
+    )
+
+def _airbnb_option(listing):
+    """Build an AirbnbOption from one search_airbnb listing"""
+    return AirbnbOption(
+        name=listing["name"],
+        price_per_night=listing["price_per_night"],
+        total_price=listing["total_price"],
+        description=listing["description"],
+        link=listing["link"],
+        property_type=listing["type"]
+    )
+
+def _extract_flight(flight, search_date, search_return, origin, destination, booking_link):
+    """Build a FlightRecord from one SerpAPI best_flights entry"""
+    legs = flight.get("flights") or ()
+    outbound = legs[0] if legs else {}
+    
+    # Direct lookups, falling back only when SerpAPI leaves a field out
+    try:
+        departure = outbound["departure_airport"]
+    except KeyError:
+        departure = {}
+    try:
+        arrival = outbound["arrival_airport"]
+    except KeyError:
+        arrival = {}
+    
+    return_departure_time = return_arrival_time = return_duration = ""
+    if len(legs) > 1:
+        inbound = legs[1]
+        try:
+            return_departure_time = inbound["departure_airport"]["time"]
+        except KeyError:
+            pass
+        try:
+            return_arrival_time = inbound["arrival_airport"]["time"]
+        except KeyError:
+            pass
+        return_duration = inbound.get("duration")
+    
+    return FlightRecord(
+        outbound_date=search_date,
+        return_date=search_return,
+        price=flight.get("price"),
+        total_duration=flight.get("total_duration"),
+        airline=outbound.get("airline", "Unknown"),
+        airline_logo=outbound.get("airline_logo", ""),
+        
+        outbound_departure_time=departure.get("time", ""),
+        outbound_arrival_time=arrival.get("time", ""),
+        outbound_departure_airport=departure.get("id", origin),
+        outbound_arrival_airport=arrival.get("id", destination),
+        outbound_duration=outbound.get("duration"),
+        
+        return_departure_time=return_departure_time,
+        return_arrival_time=return_arrival_time,
+        return_duration=return_duration,
+        
+        booking_link=booking_link,
+        layovers=outbound.get("layovers", [])
+    )
+
+class TravelPlanningAgent:
+    def __init__(self):
+        self.serpapi_key = os.environ.get("SERPAPI_KEY")
+        
+    def search_flights(self, origin, destination, outbound_date, return_date=None):
+        """Search flights with detailed times and prices"""
+        params = {
+            "engine": "google_flights",
+            "departure_id": origin.strip().upper(),
+            "arrival_id": destination.strip().upper(),
+            "outbound_date": outbound_date,
+            "currency": "GBP",
+            "hl": "en",
+            "json_restrictor": FLIGHTS_JSON_RESTRICTOR,
+            "api_key": self.serpapi_key
+        }
+        
+        if return_date:
+            params["return_date"] = return_date
+            params["type"] = "1"
+        
         try:
-            message = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=4000,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            response_text = message.content[0].text
-            
-            # Clean and parse JSON
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0].strip()
-            
-            return json.loads(response_text)
+            return serpapi_search(params, flight_cache, "best_flights")
         except Exception as e:
-            print(f"Itinerary creation error: {e}")
-            return {
-                "overview": {"destination": destination},
-                "daily_itinerary": [],
-                "restaurants": {"breakfast": [], "lunch": [], "dinner": []},
-                "budget_summary": {}
+            logger.error("Flight search error for %s-%s on %s: %r", origin, destination, outbound_date, e)
+            return {"error": str(e) or type(e).__name__}
+    
+    def search_hotels(self, destination, check_in, check_out):
+        """Search hotels with images and detailed info"""
+        params = {
+            "engine": "google_hotels",
+            "q": destination.strip().lower(),
+            "check_in_date": check_in,
+            "check_out_date": check_out,
+            "currency": "GBP",
+            "gl": "uk",
+            "hl": "en",
+            "json_restrictor": HOTELS_JSON_RESTRICTOR,
+            "api_key": self.serpapi_key
+        }
+        
+        try:
+            return serpapi_search(params, hotel_cache, "properties")
+        except Exception as e:
+            logger.error("Hotel search error for %s on %s: %r", destination, check_in, e)
+            return {"error": str(e) or type(e).__name__}
+    
+    def search_airbnb(self, destination, check_in, check_out):
+        """Build Airbnb search listings for the stay; prices are fixed estimates"""
+        nights = (date.fromisoformat(check_out) - date.fromisoformat(check_in)).days
+        
+        # The web search only ever yielded estimated prices, so link straight to
+        # Airbnb's own search instead of spending a SerpAPI call per request
+        search_url = f"https://www.airbnb.com/s/{quote(destination)}/homes"
+        return [
+            {
+                "name": f"{room_type} in {destination}",
+                "description": f"Browse {room_type.lower()} stays in {destination} for your dates",
+                "link": f"{search_url}?{urlencode({'checkin': check_in, 'checkout': check_out, 'room_types[]': room_type})}",
+                "price_per_night": "50-150",
+                "total_price": f"{nights * 75}",
+                "type": room_type
             }
+            for room_type in AIRBNB_ROOM_TYPES
+        ]
+    
+    def analyze_flexible_dates(self, origin, destination, start_date, return_date, days_range=7):
+        """Search flights across flexible dates with detailed flight info"""
+        # Back-to-back submissions for the same trip reuse the whole sweep
+        sweep_key = (origin.strip().upper(), destination.strip().upper(), start_date, return_date, days_range)
+        with local_cache_lock:
+            cached = flexible_dates_cache.get(sweep_key)
+        if cached is not None:
+            return cached
+        
+        results = []
+        base_date = date.fromisoformat(start_date)
+        return_date_obj = date.fromisoformat(return_date) if return_date else None
+        
+        date_pairs = [
+            (
+                (base_date + timedelta(days=i)).isoformat(),
+                (return_date_obj + timedelta(days=i)).isoformat() if return_date_obj else None
+            )
+            for i in range(days_range)
+        ]
+        
+        # Dates are independent, so fan the searches out; map() keeps input order
+        with ThreadPoolExecutor(max_workers=max(1, min(days_range, MAX_SEARCH_WORKERS))) as executor:
+            flight_responses = list(executor.map(
+                lambda dates: self.search_flights(origin, destination, *dates),
+                date_pairs
+            ))
+        
+        # SerpAPI can list the same flight more than once, so keep only the first of each
+        seen = set()
+        for (search_date, search_return), flight_data in zip(date_pairs, flight_responses):
+            if "best_flights" in flight_data:
+                booking_link = "https://www.google.com/travel/flights?" + urlencode({"q": f"{origin} to {destination} on {search_date}"})
+                for flight in flight_data["best_flights"][:3]:
+                    record = _extract_flight(flight, search_date, search_return, origin, destination, booking_link)
+                    key = (
+                        record.airline,
+                        record.outbound_departure_time,
+                        record.outbound_arrival_time,
+                        record.price,
+                        search_date,
+                        search_return
+                    )
+                    if key not in seen:
+                        seen.add(key)
+                        results.append(record)
+        
+        # A partial sweep could be missing the cheapest date, so only memoize complete ones
+        if results and not any("error" in flight_data for flight_data in flight_responses):
+            with local_cache_lock:
+                flexible_dates_cache[sweep_key] = results
+        return results
+    
+    def create_structured_itinerary(self, destination, keywords, budget, duration_days, hotels, history=None):
+        """Create comprehensive structured itinerary with AI; history holds earlier turns when refining"""
+        # Similar trips get the same plan, so serve repeats without calling Claude;
+        # refinements depend on the conversation so they always go to the model
+        cache_key = _itinerary_cache_key(destination, keywords, budget, duration_days)
+        if not history:
+            with itinerary_cache_lock:
+                cached = itinerary_cache.get(cache_key)
+            # Other workers' itineraries are shared through Redis when it is configured
+            if cached is None and redis_client is not None:
+                cached = _cache_get(cache_key)
+                if cached is not None:
+                    with itinerary_cache_lock:
+                        itinerary_cache[cache_key] = cached
+            if cached is not None:
+                return cached
+        
+        hotel_info = ""
+        if hotels and "properties" in hotels:
+            hotel_info = "\n\nTop Hotels:\n" + "".join(
+                f"- {hotel.get('name', 'N/A')}: £{hotel.get('rate_per_night', {}).get('lowest', 'N/A')}/night\n"
+                for hotel in hotels["properties"][:3]
+            )
+        
+        prompt = ITINERARY_REQUEST_TEMPLATE.substitute(
+            duration_days=duration_days,
+            destination=destination,
+            keywords=', '.join(keywords),
+            budget=budget,
+            hotel_info=hotel_info
+        )
+        messages = _with_cache_breakpoints(list(history or []) + [{"role": "user", "content": prompt}])
+
+        # Draft with the fast model; escalate only when it fails to return a usable itinerary
+        needed_tokens = max(ITINERARY_BASE_TOKENS + ITINERARY_TOKENS_PER_DAY * duration_days, ITINERARY_BASE_TOKENS)
+        attempts = (
+            (ITINERARY_MODEL, min(needed_tokens, ITINERARY_MAX_TOKENS)),
+            (ITINERARY_FALLBACK_MODEL, min(needed_tokens, ITINERARY_FALLBACK_MAX_TOKENS))
+        )
+        truncated_at = 0
+        for model, max_tokens in attempts:
+            if max_tokens <= truncated_at:
+                # A reply that did not fit this budget will not fit it on another model either
+                logger.warning("Skipping %s: budget of %s tokens already proved too small", model, max_tokens)
+                break
+            try:
+                itinerary = self._generate_itinerary(model, max_tokens, messages)
+                if _is_valid_itinerary(itinerary):
+                    if not history:
+                        with itinerary_cache_lock:
+                            itinerary_cache[cache_key] = itinerary
+                        if redis_client is not None:
+                            _cache_set(cache_key, ITINERARY_CACHE_TTL, itinerary)
+                    return itinerary
+                logger.warning("Itinerary from %s failed validation", model)
+            except ItineraryTruncated as e:
+                truncated_at = max_tokens
+                logger.warning("Itinerary from %s was %s", model, e)
+            except orjson.JSONDecodeError as e:
+                logger.warning("Itinerary from %s was not valid JSON: %s", model, e)
+            except Exception as e:
+                logger.error("Itinerary creation error (%s): %s", model, e)
+        
+        return {
+            "overview": {"destination": destination},
+            "daily_itinerary": [],
+            "restaurants": {"breakfast": [], "lunch": [], "dinner": []},
+            "budget_summary": {}
+        }
+    
+    def _generate_itinerary(self, model, max_tokens, messages):
+        # Stream the response so the HTTP read never sits idle on a long reply
+        with client.beta.prompt_caching.messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            # Deterministic output keeps cached and fresh itineraries consistent
+            temperature=0,
+            system=[{
+                "type": "text",
+                "text": ITINERARY_SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"}
+            }],
+            messages=messages
+        ) as stream:
+            chunks = []
+            for text in stream.text_stream:
+                chunks.append(text)
+            message = stream.get_final_message()
+        
+        usage = message.usage
+        logger.info("Itinerary %s: in=%s out=%s cache_read=%s cache_created=%s", model, usage.input_tokens,
+                    usage.output_tokens, usage.cache_read_input_tokens, usage.cache_creation_input_tokens)
+        if message.stop_reason == "max_tokens":
+            raise ItineraryTruncated(f"truncated at {max_tokens} tokens")
+        
+        response_text = "".join(chunks)
+        
+        # Clean and parse JSON
+        fenced = _FENCE_RE.search(response_text)
+        if fenced:
+            payload = fenced.group(1)
+        else:
+            # Unfenced replies sometimes wrap the object in a sentence of prose
+            start, end = response_text.find("{"), response_text.rfind("}")
+            payload = response_text[start:end + 1] if 0 <= start < end else response_text
+        return orjson.loads(payload)
     
     def find_best_value_flights(self, flight_results):
         """Sort and filter flights by value"""
-        if not flight_results:
+        # One pass collects the priced flights and their total for the average
+        priced = []
+        total = 0
+        for flight in flight_results:
+            price = flight.price
+            if price is not None:
+                priced.append(flight)
+                total += price
+        
+        if not priced:
             return []
         
-        sorted_flights = sorted(flight_results, key=lambda x: x.get("price", float('inf')))
-        prices = [f.get("price", 0) for f in flight_results if f.get("price")]
-        avg_price = sum(prices) / len(prices) if prices else 0
+        # Only the cheapest few are returned, so a bounded heap beats a full sort
+        threshold = total / len(priced) * 1.2
+        return heapq.nsmallest(8, (f for f in priced if f.price <= threshold), key=_price_key)
+
+@dataclass(frozen=True)
+class TripRequest:
+    """Canonical /itinerary input; equivalent submissions compare and hash equal"""
+    origin: str
+    destination: str
+    outbound_date: str
+    return_date: str
+    duration_days: int
+    keywords: tuple
+    budget: int | float
+    accommodation_type: str
+
+ACCOMMODATION_TYPES = ('hotel', 'airbnb', 'mixed')
+
+def normalize_request(data):
+    """Validate the /itinerary body into a TripRequest, raising ValueError on bad input"""
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object")
+    
+    try:
+        origin = (data.get('origin') or '').strip().upper()
+        destination = (data.get('destination') or '').strip().upper()
+        outbound_date = data.get('outbound_date')
+        
+        if not all([destination, origin, outbound_date]):
+            raise ValueError("Missing required fields")
+        
+        # Calculate trip duration
+        start = date.fromisoformat(outbound_date)
+        return_date = data.get('return_date')
+        if return_date:
+            end = date.fromisoformat(return_date)
+            duration_days = (end - start).days
+        else:
+            duration_days = int(data.get('duration_days', 5))
+            end = start + timedelta(days=duration_days)
         
-        best_value = [f for f in sorted_flights if f.get("price", float('inf')) <= avg_price * 1.2]
-        return best_value[:8]
+        raw_keywords = data.get('keywords', [])
+        if not isinstance(raw_keywords, list):
+            raise ValueError("Keywords must be a list")
+        # "Food, museums" and "museums, food" are the same request
+        keywords = tuple(sorted({k.strip().lower() for k in raw_keywords if k.strip()}))
+    except (TypeError, AttributeError) as e:
+        # Wrong JSON types (numbers for dates, a string for keywords, ...) are bad input too
+        raise ValueError(f"Invalid field type: {e}") from e
+    except OverflowError as e:
+        # Durations so long the return date falls outside the calendar
+        raise ValueError("Trip duration is too long") from e
+    
+    if duration_days < 1:
+        raise ValueError("Return date must be after the outbound date")
+    
+    budget = data.get('budget', 1000)
+    if isinstance(budget, bool) or not isinstance(budget, (int, float)):
+        raise ValueError("Budget must be a number")
+    
+    accommodation_type = data.get('accommodation_type', 'hotel')
+    if accommodation_type not in ACCOMMODATION_TYPES:
+        raise ValueError(f"Accommodation type must be one of: {', '.join(ACCOMMODATION_TYPES)}")
+    
+    return TripRequest(
+        origin=origin,
+        destination=destination,
+        outbound_date=start.isoformat(),
+        return_date=end.isoformat(),
+        duration_days=duration_days,
+        keywords=keywords,
+        budget=budget,
+        accommodation_type=accommodation_type
+    )
 
 agent = TravelPlanningAgent()
 
+# Shared pool for the per-request flight/hotel/itinerary stages; sized for
+# gunicorn's 8 threads per worker with up to 3 stages in flight each
+request_executor = ThreadPoolExecutor(max_workers=24, thread_name_prefix="itinerary")
+
 @app.route('/')
 def home():
     try:
@@ -297,95 +831,71 @@ def home():
 
 @app.route('/itinerary', methods=['POST'])
 def create_itinerary():
-    data = request.json
+    try:
+        trip = normalize_request(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    destination = data.get('destination')
-    keywords = data.get('keywords', [])
-    budget = data.get('budget', 1000)
-    origin = data.get('origin')
-    outbound_date = data.get('outbound_date')
-    return_date = data.get('return_date')
-    accommodation_type = data.get('accommodation_type', 'hotel')
+    include_hotels = trip.accommodation_type in ['hotel', 'mixed']
+    include_airbnb = trip.accommodation_type in ['airbnb', 'mixed']
     
-    if not all([destination, origin, outbound_date]):
-        return jsonify({"error": "Missing required fields"}), 400
+    # Flight and hotel searches are independent, so run them side by side
+    flights_future = request_executor.submit(agent.analyze_flexible_dates, trip.origin, trip.destination, trip.outbound_date, trip.return_date, 7)
+    hotels_future = request_executor.submit(agent.search_hotels, trip.destination, trip.outbound_date, trip.return_date) if include_hotels else None
     
-    # Calculate trip duration
-    if return_date:
-        start = datetime.strptime(outbound_date, "%Y-%m-%d")
-        end = datetime.strptime(return_date, "%Y-%m-%d")
-        duration_days = (end - start).days
-    else:
-        duration_days = data.get('duration_days', 5)
-        return_date = (datetime.strptime(outbound_date, "%Y-%m-%d") + timedelta(days=duration_days)).strftime("%Y-%m-%d")
+    best_flights = agent.find_best_value_flights(flights_future.result())
+    hotels = hotels_future.result() if hotels_future else None
     
-    # Search flights
-    all_flights = agent.analyze_flexible_dates(origin, destination, outbound_date, return_date, 7)
-    best_flights = agent.find_best_value_flights(all_flights)
+    # Calculate costs
+    flight_cost = best_flights[0].price if best_flights else 0
+    remaining_budget = trip.budget - flight_cost
+    
+    # Claude is the long pole; start it as soon as its inputs (budget, top hotels) are known
+    itinerary_future = request_executor.submit(
+        agent.create_structured_itinerary,
+        trip.destination,
+        trip.keywords,
+        remaining_budget,
+        trip.duration_days,
+        hotels
+    )
     
-    # Search accommodations
+    # Build accommodation options while the itinerary is generated
     hotel_options = []
     airbnb_options = []
     
-    if accommodation_type in ['hotel', 'mixed']:
-        hotels = agent.search_hotels(destination, outbound_date, return_date)
-        if hotels and "properties" in hotels:
-            for hotel in hotels.get("properties", [])[:10]:
-                hotel_options.append({
-                    "name": hotel.get("name", "N/A"),
-                    "price_per_night": hotel.get("rate_per_night", {}).get("lowest", "N/A"),
-                    "total_price": hotel.get("total_rate", {}).get("lowest", "N/A"),
-                    "rating": hotel.get("overall_rating", "N/A"),
-                    "reviews": hotel.get("reviews", 0),
-                    "link": hotel.get("link", "#"),
-                    "description": hotel.get("description", "")[:200],
-                    "images": hotel.get("images", [])[:3],
-                    "amenities": hotel.get("amenities", [])[:5],
-                    "type": "hotel"
-                })
-    
-    if accommodation_type in ['airbnb', 'mixed']:
-        airbnb_listings = agent.search_airbnb(destination, outbound_date, return_date)
-        for listing in airbnb_listings:
-            airbnb_options.append({
-                "name": listing.get("name"),
-                "price_per_night": listing.get("price_per_night"),
-                "total_price": listing.get("total_price"),
-                "description": listing.get("description"),
-                "link": listing.get("link"),
-                "type": "airbnb",
-                "property_type": listing.get("type")
-            })
+    if hotels and "properties" in hotels:
+        hotel_options = [_hotel_option(hotel) for hotel in islice(hotels["properties"], 10)]
     
-    # Calculate costs
-    flight_cost = best_flights[0].get('price', 0) if best_flights else 0
-    remaining_budget = budget - flight_cost
-    
-    # Create itinerary
-    itinerary = agent.create_structured_itinerary(
-        destination, 
-        keywords, 
-        remaining_budget, 
-        duration_days, 
-        hotels if accommodation_type in ['hotel', 'mixed'] else None
-    )
+    if include_airbnb:
+        airbnb_options = [
+            _airbnb_option(listing)
+            for listing in agent.search_airbnb(trip.destination, trip.outbound_date, trip.return_date)
+        ]
     
-    return jsonify({
-        "destination": destination,
-        "keywords": keywords,
-        "total_budget": budget,
-        "trip_duration": duration_days,
-        "outbound_date": outbound_date,
-        "return_date": return_date,
+    summary = {
+        "destination": trip.destination,
+        "keywords": trip.keywords,
+        "total_budget": trip.budget,
+        "trip_duration": trip.duration_days,
+        "outbound_date": trip.outbound_date,
+        "return_date": trip.return_date,
         "flight_options": best_flights,
         "recommended_flight_cost": flight_cost,
         "hotel_options": hotel_options,
         "airbnb_options": airbnb_options,
-        "accommodation_type": accommodation_type,
-        "remaining_budget": remaining_budget,
-        "itinerary": itinerary
-    })
+        "accommodation_type": trip.accommodation_type,
+        "remaining_budget": remaining_budget
+    }
+    
+    # Newline-delimited JSON: flights and stays go out immediately, the itinerary follows when Claude finishes
+    def generate():
+        yield orjson.dumps(summary) + b"\n"
+        yield orjson.dumps({"itinerary": itinerary_future.result()}) + b"\n"
+    
+    return Response(generate(), mimetype="application/x-ndjson")
 
+# Local development only; production runs under gunicorn -c gunicorn.conf.py
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,17 @@
+"""
+Gunicorn settings for production: gunicorn -c gunicorn.conf.py flight_agent:app
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# Processes for CPU parallelism, threads so requests blocked on SerpAPI/Claude don't stall others
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = 8
+
+# Itinerary requests wait on Claude for a long time
+timeout = 120
+keepalive = 5